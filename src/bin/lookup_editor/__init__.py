@@ -5,19 +5,151 @@ shouldn't need to call functions in the dependencies.
 """
 
 import os
-import codecs
+import io
 import json
+import itertools
 
 import splunk
 from splunk import AuthorizationFailed, ResourceNotFound
 from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
 
+# ijson is used (when available) to parse the KV store data incrementally. Only the C backend is
+# used since the pure-Python backends are much slower than the json module. Note that ijson 3.x
+# doesn't support Python 2 and fails to import with a SyntaxError.
+try:
+    import ijson.backends.yajl2_c as ijson
+except (ImportError, SyntaxError):
+    ijson = None
+
 from lookup_editor.lookup_backups import LookupBackups
 from lookup_editor.exceptions import LookupFileTooBigException, PermissionDeniedException
-from lookup_editor.shortcuts import flatten_dict
+from lookup_editor.exceptions import RESTRequestFailedException
+from lookup_editor.shortcuts import infer_kv_fields, project_rows, run_in_background
+from lookup_editor.cache import ExpiringCache
 from lookup_editor import lookupfiles
 from lookup_editor import settings
 
+# Resolving lookup paths happens on every view of the editor; these are bound here so that each
+# use is a single global lookup instead of an attribute lookup on the os module
+_basename = os.path.basename
+_stat = os.stat
+
+def _safe_basename(name):
+    """
+    Strip any directory from the name (like os.path.basename()), skipping the work in the common
+    case of a name that has no path separators (or drive) within it.
+    """
+
+    if '/' not in name and '\\' not in name and ':' not in name and '..' not in name:
+        return name
+
+    return _basename(name)
+
+# The endpoints for the configuration and the data of a KV store collection
+KV_CONFIG_PATH = '/servicesNS/nobody/%s/storage/collections/config/%s'
+KV_DATA_PATH = '/servicesNS/%s/%s/storage/collections/data/%s'
+
+# The arguments for requesting a JSON response from splunkd
+JSON_OUTPUT_ARGS = {'output_mode': 'json'}
+
+def _rest_request(path, session_key, **kwargs):
+    """
+    Perform a request against splunkd. All of the REST calls made by this module go through here
+    so that the transport is handled in one place. Note that httplib2 (which simpleRequest uses)
+    already requests a compressed response and decompresses it.
+    """
+
+    return splunk.rest.simpleRequest(path, sessionKey=session_key, **kwargs)
+
+def _check_or_raise(response, content):
+    """
+    Raise a PermissionDeniedException if splunkd denied the request or a
+    RESTRequestFailedException if the request was otherwise unsuccessful; if it was successful,
+    return the response and content.
+    """
+
+    if response.status == 403:
+        raise PermissionDeniedException("You do not have permission to view this lookup")
+
+    if response.status != 200:
+        raise RESTRequestFailedException(response.status, content)
+
+    return response, content
+
+# This caches the KV store collection configurations (keyed on the request path and session key)
+# so that repeated loads of the same lookup don't have to go back to splunkd for the fields. The
+# collection data isn't cached since the UI modifies it directly through splunkd.
+kv_config_cache = ExpiringCache(settings.KV_CONFIG_CACHE_MAXIMUM_ENTRIES,
+                                settings.KV_CONFIG_CACHE_TTL)
+
+def _cached_request(path, session_key):
+    """
+    Perform a GET request for JSON content against splunkd, re-using a previous response if one
+    was made recently. The content is returned parsed; only successful responses are cached.
+    """
+
+    cache_key = (path, session_key)
+    cached = kv_config_cache.get(cache_key)
+
+    if cached is not None:
+        return cached
+
+    response, content = _rest_request(path, session_key, getargs=JSON_OUTPUT_ARGS)
+
+    if response.status != 200:
+        return response, content
+
+    result = (response, json.loads(content))
+    kv_config_cache.set(cache_key, result)
+
+    return result
+
+# This caches the paths of lookup files as reported by splunkd (keyed on the lookup, namespace,
+# owner and session key). A cached path is dropped when the lookup is backed up before being
+# saved or when the file is found to no longer exist. Otherwise, a change made outside of this
+# process (such as a change to the lookup's sharing) may not be noticed until the entry expires.
+lookup_path_cache = ExpiringCache(settings.LOOKUP_PATH_CACHE_MAXIMUM_ENTRIES,
+                                  settings.LOOKUP_PATH_CACHE_TTL)
+
+def _get_lookup_table_path(lookup_file, namespace, owner, session_key):
+    """
+    Get the path of the lookup file from splunkd, re-using the path from a recent request if
+    possible. Returns a tuple of the path and whether it came from the cache.
+    """
+
+    cache_key = (lookup_file, namespace, owner, session_key)
+    path = lookup_path_cache.get(cache_key)
+
+    if path is not None:
+        return path, True
+
+    path = lookupfiles.SplunkLookupTableFile.get(lookupfiles.SplunkLookupTableFile.build_id(lookup_file, namespace, owner), sessionKey=session_key).path
+    lookup_path_cache.set(cache_key, path)
+
+    return path, False
+
+def _invalidate_lookup_path_cache(lookup_file, namespace):
+    """
+    Remove the cached paths for the given lookup (for all owners and sessions).
+    """
+
+    lookup_file = _safe_basename(lookup_file)
+    namespace = _safe_basename(namespace)
+
+    lookup_path_cache.invalidate(lambda key: key[0] == lookup_file and key[1] == namespace)
+
+def _iterate_rows(content):
+    """
+    Iterate through the rows of KV store collection data. The data is parsed incrementally if ijson
+    is available; ijson produces Decimals for non-integer numbers, which project_rows() converts
+    to floats.
+    """
+
+    if ijson is not None:
+        return ijson.items(io.BytesIO(content), 'item')
+
+    return iter(json.loads(content))
+
 class LookupEditor(LookupBackups):
     """
     This class provides functions for editing lookup files. It is bundled in an instantiable class
@@ -29,72 +161,86 @@ class LookupEditor(LookupBackups):
     def __init__(self, logger):
         super(LookupEditor, self).__init__(logger)
 
-    def get_kv_lookup(self, session_key, lookup_file, namespace="lookup_editor", owner=None):
+    def get_kv_lookup(self, session_key, lookup_file, namespace="lookup_editor", owner=None,
+                      infer_fields=False):
+        """
+        Get the contents of a KV store lookup as a list of rows (the first of which is the header).
+        See iter_kv_lookup() for the arguments.
+        """
+
+        return list(self.iter_kv_lookup(session_key, lookup_file, namespace, owner, infer_fields))
+
+    def iter_kv_lookup(self, session_key, lookup_file, namespace="lookup_editor", owner=None,
+                       infer_fields=False):
         """
-        Get the contents of a KV store lookup.
+        Iterate through the contents of a KV store lookup. The header is produced first, followed
+        by each row; the rows are converted as they are consumed so that the entire table doesn't
+        need to be held in memory.
+
+        If infer_fields is true, the fields will be determined from the first rows of the lookup
+        instead of from the collection's configuration, which saves a request to splunkd. This is
+        only suitable for collections whose rows all have the same fields. The configuration is
+        still used if the collection is empty.
         """
 
         if owner is None:
             owner = 'nobody'
 
-        lookup_contents = []
-
         # Get the fields so that we can compose the header
         # Note: this call must be done with the user context of "nobody".
-        response, content = splunk.rest.simpleRequest('/servicesNS/nobody/' + namespace +
-                                                      '/storage/collections/config/' +
-                                                      lookup_file,
-                                                      sessionKey=session_key,
-                                                      getargs={'output_mode': 'json'})
-
-        if response.status == 403:
-            raise PermissionDeniedException("You do not have permission to view this lookup")
-
-        header = json.loads(content)
+        config_path = KV_CONFIG_PATH % (namespace, lookup_file)
 
-        fields = ['_key']
+        def get_header():
+            return _check_or_raise(*_cached_request(config_path, session_key))
 
-        for field in header['entry'][0]['content']:
-            if field.startswith('field.'):
-                fields.append(field[6:])
+        # If the configuration isn't cached, it is requested on another thread so that both
+        # requests are in flight at the same time.
+        header_request = None
 
-        lookup_contents.append(fields)
+        if not infer_fields and kv_config_cache.get((config_path, session_key)) is None:
+            header_request = run_in_background(get_header)
 
         # Get the contents
-        response, content = splunk.rest.simpleRequest('/servicesNS/' + owner + '/' + namespace +
-                                                      '/storage/collections/data/' + lookup_file,
-                                                      sessionKey=session_key,
-                                                      getargs={'output_mode': 'json'})
+        _, content = _check_or_raise(*_rest_request(KV_DATA_PATH % (owner, namespace, lookup_file),
+                                                    session_key, getargs=JSON_OUTPUT_ARGS))
 
-        if response.status == 403:
-            raise PermissionDeniedException("You do not have permission to view this lookup")
+        rows = _iterate_rows(content)
+        fields = None
 
-        rows = json.loads(content)
+        # Determine the fields from the first rows
+        if infer_fields:
+            sample_rows = list(itertools.islice(rows, settings.KV_FIELD_INFERENCE_ROWS))
 
-        for row in rows:
-            new_row = []
+            if len(sample_rows) > 0:
+                fields = infer_kv_fields(sample_rows)
+                rows = itertools.chain(sample_rows, rows)
 
-            # Convert the JSON style format of the row and convert it down to chunk of text
-            flattened_row = flatten_dict(row, fields=fields)
+        # Determine the fields from the collection's configuration
+        if fields is None:
+            if header_request is not None:
+                _, header = header_request.result()
+            else:
+                _, header = get_header()
 
-            # Add each field to the table row
-            for field in fields:
+            fields = ['_key'] + [field[6:] for field in header['entry'][0]['content']
+                                 if field.startswith('field.')]
 
-                # If the field was found, add it
-                if field in flattened_row:
-                    new_row.append(flattened_row[field])
+        yield fields
 
-                # If the field wasn't found, add a blank string. We need to do this to make
-                # sure that the number of columns is consistent. We can't have fewer data
-                # columns than we do header columns. Otherwise, the header won't line up with
-                # the field since the number of columns items in the header won't match the
-                # number of columns in the rows.
-                else:
-                    new_row.append("")
+        # Produce each row with the values in the same order as the header
+        for row in project_rows(rows, fields):
+            yield row
 
-            lookup_contents.append(new_row)
+    def backup_lookup_file(self, lookup_file, namespace, resolved_file_path, owner=None):
+        """
+        Make a backup of the lookup file. The lookup is about to be replaced so the cached path of
+        it is dropped too.
+        """
+
+        _invalidate_lookup_path_cache(lookup_file, namespace)
 
-        return lookup_contents
+        return super(LookupEditor, self).backup_lookup_file(lookup_file, namespace,
+                                                            resolved_file_path, owner)
 
     def get_lookup(self, session_key, lookup_file, namespace="lookup_editor", owner=None,
                    get_default_csv=True, version=None, throw_exception_if_too_big=False):
@@ -107,14 +253,18 @@ class LookupEditor(LookupBackups):
         # Check capabilities
         #LookupEditor.check_capabilities(lookup_file, user, session_key)
 
-        # Get the file path
-        file_path = self.resolve_lookup_filename(lookup_file, namespace, owner, get_default_csv,
-                                                 version, session_key=session_key)
+        # Get the file path (and the file's status if it was already determined)
+        file_path, file_stat = self.resolve_lookup_file_stat(lookup_file, namespace, owner,
+                                                             get_default_csv, version,
+                                                             session_key=session_key)
 
         if throw_exception_if_too_big:
 
             try:
-                file_size = os.path.getsize(file_path)
+                if file_stat is not None:
+                    file_size = file_stat.st_size
+                else:
+                    file_size = os.path.getsize(file_path)
 
                 self.logger.info('Size of lookup file determined, file_size=%s, path=%s',
                                  file_size, file_path)
@@ -130,8 +280,10 @@ class LookupEditor(LookupBackups):
 
         # Get the file handle
         # Note that we are assuming that the file is in UTF-8. Any characters that don't match
-        # will be replaced.
-        return codecs.open(file_path, 'rb', encoding='utf-8', errors='replace')
+        # will be replaced. Line endings are left untranslated so that the CSV reader can handle
+        # newlines within quoted values.
+        return io.open(file_path, 'r', buffering=settings.LOOKUP_READ_BUFFER_SIZE,
+                       encoding='utf-8', errors='replace', newline='')
 
 
     def resolve_lookup_filename(self, lookup_file, namespace="lookup_editor", owner=None,
@@ -146,17 +298,35 @@ class LookupEditor(LookupBackups):
         correctly; this shouldn't be used for determining the path of a new file.
         """
 
+        resolved = self.resolve_lookup_file_stat(lookup_file, namespace, owner, get_default_csv,
+                                                 version, throw_not_found, session_key)
+
+        if resolved is None:
+            return None
+
+        return resolved[0]
+
+    def resolve_lookup_file_stat(self, lookup_file, namespace="lookup_editor", owner=None,
+                                 get_default_csv=True, version=None, throw_not_found=True,
+                                 session_key=None):
+        """
+        Resolve the lookup filename (see resolve_lookup_filename()) and return a tuple of the path
+        and the result of os.stat() for it. The status will be None if it wasn't needed in order
+        to resolve the path (or if the file doesn't exist).
+        """
+
         # Strip out invalid characters like ".." so that this cannot be used to conduct an
         # directory traversal
-        lookup_file = os.path.basename(lookup_file)
-        namespace = os.path.basename(namespace)
+        lookup_file = _safe_basename(lookup_file)
+        namespace = _safe_basename(namespace)
 
         if owner is not None:
-            owner = os.path.basename(owner)
+            owner = _safe_basename(owner)
 
         # Determine the lookup path by asking Splunk
         try:
-            resolved_lookup_path = lookupfiles.SplunkLookupTableFile.get(lookupfiles.SplunkLookupTableFile.build_id(lookup_file, namespace, owner), sessionKey=session_key).path
+            resolved_lookup_path, path_was_cached = _get_lookup_table_path(lookup_file, namespace,
+                                                                           owner, session_key)
         except ResourceNotFound:
             if throw_not_found:
                 raise
@@ -191,10 +361,26 @@ class LookupEditor(LookupBackups):
         self.logger.info('Resolved lookup file, path=%s', lookup_path)
 
         # Get the file path
-        if get_default_csv and not os.path.exists(lookup_path) and os.path.exists(lookup_path_default):
-            return lookup_path_default
-        else:
-            return lookup_path
+        if not get_default_csv:
+            return lookup_path, None
+
+        try:
+            return lookup_path, _stat(lookup_path)
+        except OSError:
+            # The cached path is out of date if the file was moved or removed since it was cached;
+            # drop it and ask splunkd again
+            if path_was_cached and lookup_path == resolved_lookup_path:
+                _invalidate_lookup_path_cache(lookup_file, namespace)
+
+                return self.resolve_lookup_file_stat(lookup_file, namespace, owner,
+                                                     get_default_csv, version, throw_not_found,
+                                                     session_key)
+
+        # Use the default lookup since the lookup itself doesn't exist
+        try:
+            return lookup_path_default, _stat(lookup_path_default)
+        except OSError:
+            return lookup_path, None
 
     def is_empty(self, row):
         """
@@ -202,15 +388,33 @@ class LookupEditor(LookupBackups):
         are empty.
         """
 
-        for entry in row:
-            if entry is not None and len(entry.strip()) > 0:
-                return False
-
-        return True
+        # None and blank entries are both falsy so any() stops at the first non-empty entry
+        return not any(entry and entry.strip() for entry in row)
 
     def force_lookup_replication(self, app, filename, session_key, base_uri=None):
         """
-        Force replication of a lookup table in a Search Head Cluster.
+        Force replication of a lookup table in a Search Head Cluster. The replication request is
+        made in the background so that the caller doesn't have to wait on it; this returns the
+        BackgroundTask whose result() is the response from force_lookup_replication_sync().
+        """
+
+        return run_in_background(self._force_lookup_replication_logged, app, filename,
+                                 session_key, base_uri)
+
+    def _force_lookup_replication_logged(self, app, filename, session_key, base_uri=None):
+        """
+        Force replication of a lookup table, logging the failure if the request could not be made.
+        """
+
+        try:
+            return self.force_lookup_replication_sync(app, filename, session_key, base_uri)
+        except Exception:
+            self.logger.exception('Lookup table replication failed for %s', filename)
+            raise
+
+    def force_lookup_replication_sync(self, app, filename, session_key, base_uri=None):
+        """
+        Force replication of a lookup table in a Search Head Cluster and wait for the response.
         """
 
         # Permit override of base URI in order to target a remote server.
@@ -229,11 +433,10 @@ class LookupEditor(LookupBackups):
         }
 
         # Perform the request
-        response, content = splunk.rest.simpleRequest(repl_uri,
-                                                      method='POST',
-                                                      postargs=payload,
-                                                      sessionKey=session_key,
-                                                      raiseAllErrors=False)
+        response, content = _rest_request(repl_uri, session_key,
+                                          method='POST',
+                                          postargs=payload,
+                                          raiseAllErrors=False)
 
         # Analyze the response
         if response.status == 400:
@@ -0,0 +1,83 @@
+"""
+This module provides a small in-process cache for holding on to the results of expensive calls
+(such as REST requests to splunkd) for a limited amount of time.
+"""
+
+import time
+
+class ExpiringCache(object):
+    """
+    A dictionary-like cache whose entries expire after a time-to-live. The cache is bounded; once
+    the maximum size is reached, expired entries are purged and then the entries closest to
+    expiring are evicted.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, key, default=None):
+        """
+        Get the value for the given key or the default if the entry does not exist or has expired.
+        """
+
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return default
+
+        expires, value = entry
+
+        if time.time() >= expires:
+            self.entries.pop(key, None)
+            return default
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store the value for the given key. The cache-wide time-to-live will be used unless one is
+        provided.
+        """
+
+        if ttl is None:
+            ttl = self.ttl
+
+        if key not in self.entries and len(self.entries) >= self.maxsize:
+            self.purge()
+
+        self.entries[key] = (time.time() + ttl, value)
+
+    def purge(self):
+        """
+        Remove the expired entries and, if the cache is still full, the entries closest to expiring.
+        """
+
+        now = time.time()
+
+        for key, (expires, _) in list(self.entries.items()):
+            if now >= expires:
+                self.entries.pop(key, None)
+
+        if len(self.entries) >= self.maxsize:
+            by_expiration = sorted(self.entries.items(), key=lambda item: item[1][0])
+
+            for key, _ in by_expiration[:len(self.entries) - self.maxsize + 1]:
+                self.entries.pop(key, None)
+
+    def invalidate(self, matches):
+        """
+        Remove all of the entries whose key is accepted by the given function.
+        """
+
+        for key in list(self.entries.keys()):
+            if matches(key):
+                self.entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+
+        self.entries.clear()
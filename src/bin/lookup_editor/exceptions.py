@@ -23,3 +23,21 @@ class LookupFileTooBigException(Exception):
 
         # Remember the file-size
         self.file_size = file_size
+
+"""
+Represents an exception when splunkd returned an unsuccessful response to a request.
+"""
+class RESTRequestFailedException(Exception):
+    """
+    Represents an exception caused by a request to splunkd not being successful.
+    """
+
+    def __init__(self, status, content):
+
+        # Call the base class constructor with the parameters it needs
+        super(RESTRequestFailedException, self).__init__("Request to splunkd failed, status=%s" %
+                                                         status)
+
+        # Remember the response
+        self.status = status
+        self.content = content
@@ -1,2 +1,14 @@
 
 MAXIMUM_EDITABLE_SIZE = 10 * 1024 * 1024 # 10 MB
+LOOKUP_READ_BUFFER_SIZE = 1024 * 1024 # 1 MB
+
+# Caching of KV store collection configurations
+KV_CONFIG_CACHE_MAXIMUM_ENTRIES = 512
+KV_CONFIG_CACHE_TTL = 600 # 10 minutes; the collection schema rarely changes
+
+# Caching of the lookup file paths reported by splunkd
+LOOKUP_PATH_CACHE_MAXIMUM_ENTRIES = 1024
+LOOKUP_PATH_CACHE_TTL = 60 # 1 minute
+
+# The number of KV store rows examined when inferring the fields of a collection from its data
+KV_FIELD_INFERENCE_ROWS = 100
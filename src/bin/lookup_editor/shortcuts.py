@@ -4,11 +4,14 @@ This module includes generic functions useful when processing lookup files.
 
 import re
 import os
+import sys
 import csv
 import json
 import StringIO # For converting KV store array data to CSV for export
 import collections
+import decimal
 import logging
+import threading
 
 from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
 
@@ -64,6 +67,212 @@ def flatten_dict(dict_source, output=None, prefix='', fields=None):
 
     return output
 
+def find_field_path(row, field, field_set):
+    """
+    Find the keys to walk in the row to get the value of the field as flatten_dict() would, or None
+    if the row doesn't include the field. At each level, the key is either the rest of the field
+    name or the key of a nested dictionary that starts the rest of the field name. Only the keys
+    present in the row are followed so the work is bounded by the row (and the depth of the field)
+    rather than by the number of ways to split the field name.
+    """
+
+    if not isinstance(row, dict):
+        return None
+
+    # Each entry is a dictionary, the keys walked to get to it and the start of the rest of the name
+    pending = [(row, (), 0)]
+
+    while pending:
+        value, path, start = pending.pop()
+
+        # Stop if the rest of the field name is a key itself
+        if field[start:] in value:
+            return path + (field[start:],)
+
+        # Follow each nested dictionary whose key starts the rest of the field name
+        end = field.find('.', start)
+
+        while end != -1:
+            key = field[start:end]
+
+            # flatten_dict() doesn't descend into a field, so a parent that is a field is skipped
+            if key in value and isinstance(value[key], dict) and field[:end] not in field_set:
+                pending.append((value[key], path + (key,), end + 1))
+
+            end = field.find('.', end + 1)
+
+    return None
+
+def compile_flatten_plan(sample_row, fields):
+    """
+    Determine how to get the value of each of the given fields from the rows, giving the same
+    values that flatten_dict() would. This returns a list with the path (a tuple of keys to walk)
+    to try first for each field, or None if there isn't one.
+
+    The rows of a collection don't necessarily share the same layout: the CSV import stores a
+    field like "a.b" as a key that contains a period while edits in the editor store it as a
+    nested dictionary. The path is the layout found in the sample row; get_planned_value() falls
+    back to find_field_path() for rows that are laid out differently.
+    """
+
+    field_set = frozenset(fields)
+    plan = []
+
+    for field in fields:
+        path = find_field_path(sample_row, field, field_set)
+
+        # If the sample row doesn't include the field, then assume the periods separate keys
+        if path is None:
+            path = tuple(field.split('.'))
+
+            # flatten_dict() doesn't descend into a field, so the path is unreachable if a parent
+            # along it is a field too
+            if any('.'.join(path[:i]) in field_set for i in range(1, len(path))):
+                path = None
+
+        plan.append(path)
+
+    return plan
+
+def decimal_to_float(value):
+    """
+    Convert a Decimal (which ijson produces for non-integer numbers) to a float. This can be used as
+    the default function for json.dumps().
+    """
+
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+# Returned by walk_path() when the row doesn't have the value (since None is a valid value)
+MISSING = object()
+
+def walk_path(row, path):
+    """
+    Get the value at the end of the path of keys in the row, or MISSING if the row doesn't have it.
+    """
+
+    value = row
+
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+
+        value = value[key]
+
+    return value
+
+def get_planned_value(row, field, path, field_set):
+    """
+    Get the value of a field from the row by walking the path from compile_flatten_plan(),
+    searching the row for the field if the path doesn't lead to a value. A blank string is returned
+    for fields that are not present. Dictionaries and arrays are rendered as JSON. Decimals are
+    converted to floats.
+    """
+
+    value = MISSING if path is None else walk_path(row, path)
+
+    # The row is laid out differently than the sample row (or lacks the field)
+    if value is MISSING:
+        path = find_field_path(row, field, field_set)
+
+        if path is None:
+            return ""
+
+        value = walk_path(row, path)
+
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, default=decimal_to_float)
+
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+
+    return value
+
+def project_rows(rows, fields):
+    """
+    Convert the given KV store rows into lists of values in the order of the given fields.
+
+    Fields that aren't found are added as a blank string. We need to do this to make sure that the
+    number of columns is consistent. We can't have fewer data columns than we do header columns.
+    Otherwise, the header won't line up with the field since the number of columns items in the
+    header won't match the number of columns in the rows.
+    """
+
+    field_set = frozenset(fields)
+    plan = None
+
+    for row in rows:
+
+        # Work out how to get each field once, using the first row as the sample
+        if plan is None:
+            plan = list(zip(fields, compile_flatten_plan(row, fields)))
+
+        yield [get_planned_value(row, field, path, field_set) for field, path in plan]
+
+def infer_kv_fields(rows):
+    """
+    Determine the fields of a KV store collection from the given rows. This consists of "_key"
+    followed by the sorted union of the other keys once the rows are flattened (so a nested value
+    produces a field like "configuration.delay", matching how fields are configured); the other
+    internal fields (those starting with an underscore, like "_user") are excluded.
+    """
+
+    keys = set()
+
+    for row in rows:
+        keys.update(flatten_dict(row).keys())
+
+    return ['_key'] + sorted(key for key in keys if not key.startswith('_'))
+
+class BackgroundTask(threading.Thread):
+    """
+    Runs a function on a separate thread so that blocking I/O (such as a REST call) can overlap
+    with other work. Call result() to wait for the function to finish and get its return value; an
+    exception raised by the function will be raised by result() with its original traceback.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        super(BackgroundTask, self).__init__()
+        self.daemon = True
+
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+        self.value = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.value = self.function(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def result(self):
+        """
+        Wait for the function to complete and return the value it returned.
+        """
+
+        self.join()
+
+        if self.exc_info is not None:
+            exc_type, exc_value, exc_traceback = self.exc_info
+            raise exc_type, exc_value, exc_traceback
+
+        return self.value
+
+def run_in_background(function, *args, **kwargs):
+    """
+    Start running the given function on a separate thread and return the BackgroundTask.
+    """
+
+    task = BackgroundTask(function, *args, **kwargs)
+    task.start()
+
+    return task
+
 def escape_filename(file_name):
     """
     Return a file name the excludes special characters (replaced with underscores)
@@ -15,6 +15,7 @@ from splunk import AuthorizationFailed, ResourceNotFound
 from lookup_editor import LookupEditor
 from lookup_editor import shortcuts
 from lookup_editor.exceptions import LookupFileTooBigException, PermissionDeniedException
+from lookup_editor.exceptions import RESTRequestFailedException
 
 import rest_handler
 
@@ -121,7 +122,9 @@ class LookupEditorHandler(rest_handler.RESTHandler):
 
             # Load the KV store lookup
             if lookup_type == "kv":
-                return self.render_json(self.lookup_editor.get_kv_lookup(lookup_file, namespace, owner))
+                return self.render_json(self.lookup_editor.get_kv_lookup(request_info.session_key,
+                                                                         lookup_file, namespace,
+                                                                         owner))
 
             # Load the CSV lookup
             elif lookup_type == "csv":
@@ -157,6 +160,15 @@ class LookupEditorHandler(rest_handler.RESTHandler):
             self.logger.warning("Access to lookup denied")
             return self.render_error_json(str(e), 403)
 
+        except RESTRequestFailedException as e:
+            if e.status == 404:
+                self.logger.warning("Unable to find the requested lookup")
+                return self.render_error_json("Unable to find the lookup", 404)
+
+            self.logger.error('Lookup could not be loaded, status=%s, content="%s"', e.status,
+                              e.content)
+            return self.render_error_json('Lookup file could not be loaded', 500)
+
         except LookupFileTooBigException as e:
             self.logger.warning("Lookup file is too large to load")
 
@@ -196,7 +208,8 @@ class LookupEditorHandler(rest_handler.RESTHandler):
 
             # If we are getting a KV store lookup, then convert it to a CSV file
             else:
-                rows = self.lookup_editor.get_kv_lookup(lookup_file, namespace, owner)
+                rows = self.lookup_editor.iter_kv_lookup(request_info.session_key, lookup_file,
+                                                         namespace, owner)
                 csv_data = shortcuts.convert_array_to_csv(rows)
 
             # Tell the browser to download this as a file
@@ -220,6 +233,12 @@ class LookupEditorHandler(rest_handler.RESTHandler):
         except PermissionDeniedException as exception:
             return self.render_error_json(str(exception), 403)
 
+        except RESTRequestFailedException as exception:
+            if exception.status == 404:
+                return self.render_json([], 404)
+
+            return self.render_error_json(str(exception), 500)
+
         return {
             'payload': str(lookup_file),  # Payload of the request.
             'status': 200                 # HTTP status code
@@ -2,11 +2,16 @@ import unittest
 import sys
 import os
 import json
+import random
+import logging
 
 sys.path.append( os.path.join("..", "src", "bin") )
 sys.path.append( os.path.join("..", "src", "appserver", "controllers") )
 
 from lookup_edit import LookupEditor
+import lookup_editor
+from lookup_editor import shortcuts
+from lookup_editor.cache import ExpiringCache
 
 class TestLookupEditController(unittest.TestCase):
     
@@ -73,9 +78,278 @@ class TestLookupEditController(unittest.TestCase):
     def test_flatten_dict_specified_fields_hierarchical(self):
         pass
         
+class TestProjectRows(unittest.TestCase):
+
+    def flatten_rows(self, rows, fields):
+        """
+        Project the rows using flatten_dict(), the way that KV store lookups were originally
+        converted.
+        """
+
+        projected = []
+
+        for row in rows:
+            flattened_row = shortcuts.flatten_dict(row, fields=fields)
+            projected.append([flattened_row.get(field, "") for field in fields])
+
+        return projected
+
+    def has_colliding_keys(self, row):
+        """
+        Determine if the row has a key containing a period that is also present as nested
+        dictionaries (in which case flatten_dict() picks one arbitrarily).
+        """
+
+        for key in row:
+            if '.' in key:
+                value = row
+
+                for part in key.split('.'):
+                    if not isinstance(value, dict) or part not in value:
+                        break
+
+                    value = value[part]
+                else:
+                    return True
+
+        return False
+
+    def make_value(self, generator, depth):
+
+        choice = generator.random()
+
+        if depth < 2 and choice < 0.3:
+            return dict((key, self.make_value(generator, depth + 1))
+                        for key in generator.sample('abc', generator.randint(0, 3)))
+        elif choice < 0.4:
+            return [1, {'q': 2}]
+        elif choice < 0.5:
+            return None
+        else:
+            return generator.choice(['x', 1, 2.5, u'y'])
+
+    def test_project_rows_matches_flatten_dict(self):
+
+        generator = random.Random(1)
+
+        for _ in range(3000):
+            rows = []
+
+            while len(rows) < 3:
+                row = {'_key': str(len(rows))}
+
+                for key in generator.sample(['a', 'b', 'c', 'a.b', 'a.c', 'b.a'],
+                                            generator.randint(0, 4)):
+                    row[key] = self.make_value(generator, 0)
+
+                if not self.has_colliding_keys(row):
+                    rows.append(row)
+
+            fields = ['_key'] + generator.sample(['a', 'b', 'c', 'a.b', 'a.c', 'b.a', 'a.b.c',
+                                                  'c.a.b', 'a.a'], 4)
+
+            self.assertEquals(list(shortcuts.project_rows(rows, fields)),
+                              self.flatten_rows(rows, fields))
+
+    def test_project_rows_mixed_layouts(self):
+
+        # A row imported from a CSV file followed by one edited in the editor
+        rows = [{'_key': '1', 'a.b': 1}, {'_key': '2', 'a': {'b': 2}}]
+        fields = ['_key', 'a.b']
+
+        self.assertEquals(list(shortcuts.project_rows(rows, fields)), [['1', 1], ['2', 2]])
+        self.assertEquals(list(shortcuts.project_rows(reversed(rows), fields)),
+                          [['2', 2], ['1', 1]])
+
+    def test_project_rows_parent_field(self):
+
+        # A field within another field is rendered within the parent's JSON
+        rows = [{'_key': '1', 'a': {'b': 1}}]
+
+        self.assertEquals(list(shortcuts.project_rows(rows, ['_key', 'a', 'a.b'])),
+                          [['1', '{"b": 1}', '']])
+
+    def test_project_rows_missing_fields(self):
+
+        rows = [{'_key': '1', 'name': 'Test'}, {'_key': '2'}]
+
+        self.assertEquals(list(shortcuts.project_rows(rows, ['_key', 'name', 'configuration.delay'])),
+                          [['1', 'Test', ''], ['2', '', '']])
+
+    def test_project_rows_deep_field(self):
+
+        # There are 2^39 ways to split this field name into keys so rows that aren't laid out like
+        # the first one must be resolved without trying each of them
+        parts = ['part%i' % i for i in range(40)]
+        field = '.'.join(parts)
+
+        nested = 'nested'
+
+        for part in reversed(parts):
+            nested = {part: nested}
+
+        rows = [
+            {'_key': '1', field: 'literal'},
+            {'_key': '2', 'a': 1},
+            dict(nested, _key='3'),
+            {'_key': '4', '.'.join(parts[:20]): {'.'.join(parts[20:]): 'mixed'}}
+        ]
+
+        self.assertEquals(list(shortcuts.project_rows(rows, ['_key', field])),
+                          [['1', 'literal'], ['2', ''], ['3', 'nested'], ['4', 'mixed']])
+
+class TestExpiringCache(unittest.TestCase):
+
+    def test_get_set(self):
+
+        cache = ExpiringCache(10, 60)
+        cache.set('a', 1)
+
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('b', 2), 2)
+
+    def test_expiry(self):
+
+        cache = ExpiringCache(10, 60)
+        cache.set('a', 1, ttl=0)
+
+        self.assertEquals(cache.get('a'), None)
+        self.assertFalse('a' in cache.entries)
+
+    def test_eviction(self):
+
+        cache = ExpiringCache(2, 60)
+        cache.set('a', 1, ttl=30)
+        cache.set('b', 2)
+        cache.set('c', 3)
+
+        # The entry closest to expiring should have been evicted
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.get('b'), 2)
+        self.assertEquals(cache.get('c'), 3)
+
+    def test_eviction_expired_first(self):
+
+        cache = ExpiringCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=0)
+        cache.set('c', 3)
+
+        # The expired entry should have been purged rather than the live one
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(len(cache.entries), 2)
+
+    def test_invalidate(self):
+
+        cache = ExpiringCache(10, 60)
+        cache.set(('lookup', 'session_a'), 1)
+        cache.set(('lookup', 'session_b'), 2)
+        cache.set(('other', 'session_a'), 3)
+
+        cache.invalidate(lambda key: key[0] == 'lookup')
+
+        self.assertEquals(cache.get(('lookup', 'session_a')), None)
+        self.assertEquals(cache.get(('lookup', 'session_b')), None)
+        self.assertEquals(cache.get(('other', 'session_a')), 3)
+
+class TestInferKVFields(unittest.TestCase):
+
+    def test_infer_kv_fields(self):
+
+        rows = [
+            {'_key': '1', '_user': 'nobody', 'name': 'Test', 'configuration': {'delay': 300}},
+            {'_key': '2', '_user': 'nobody', 'address': '127.0.0.1'}
+        ]
+
+        self.assertEquals(shortcuts.infer_kv_fields(rows),
+                          ['_key', 'address', 'configuration.delay', 'name'])
+
+    def test_infer_kv_fields_empty(self):
+
+        self.assertEquals(shortcuts.infer_kv_fields([]), ['_key'])
+
+class StubResponse(dict):
+    """
+    A stand-in for the response returned by splunk.rest.simpleRequest().
+    """
+
+    def __init__(self, status):
+        super(StubResponse, self).__init__()
+        self.status = status
+
+class TestIterKVLookup(unittest.TestCase):
+
+    CONFIG = {'entry': [{'content': {'field.name': 'string', 'field.configuration.delay': 'number'}}]}
+
+    def setUp(self):
+        self.rest_request = lookup_editor._rest_request
+        self.ijson = lookup_editor.ijson
+        self.requests = []
+        self.data = []
+
+        def rest_request(path, session_key, **kwargs):
+            self.requests.append(path)
+
+            if '/storage/collections/config/' in path:
+                return StubResponse(200), json.dumps(self.CONFIG)
+            else:
+                return StubResponse(200), json.dumps(self.data)
+
+        lookup_editor._rest_request = rest_request
+        lookup_editor.kv_config_cache.clear()
+
+    def tearDown(self):
+        lookup_editor._rest_request = self.rest_request
+        lookup_editor.ijson = self.ijson
+        lookup_editor.kv_config_cache.clear()
+
+    def get_kv_lookup(self, infer_fields):
+        editor = lookup_editor.LookupEditor(logging.getLogger())
+        return editor.get_kv_lookup('session_key', 'test_collection', infer_fields=infer_fields)
+
+    def test_infer_fields(self):
+
+        self.data = [{'_key': str(i), '_user': 'nobody', 'name': 'Test %i' % i,
+                      'configuration': {'delay': i}} for i in range(250)]
+
+        expected = [['_key', 'configuration.delay', 'name']]
+        expected.extend([str(i), i, 'Test %i' % i] for i in range(250))
+
+        # Check both the json module (whose rows are a list) and ijson (if it is installed)
+        for ijson in set([None, self.ijson]):
+            lookup_editor.ijson = ijson
+            del self.requests[:]
+
+            self.assertEquals(self.get_kv_lookup(infer_fields=True), expected)
+            self.assertEquals(len(self.requests), 1)
+
+    def test_infer_fields_empty_collection(self):
+
+        # The fields come from the configuration, which doesn't keep them in any particular order
+        header, = self.get_kv_lookup(infer_fields=True)
+
+        self.assertEquals(header[0], '_key')
+        self.assertEquals(sorted(header[1:]), ['configuration.delay', 'name'])
+        self.assertEquals(len(self.requests), 2)
+
+class TestSafeBasename(unittest.TestCase):
+
+    def test_safe_basename(self):
+
+        for name in ['test.csv', '../test.csv', 'some_app/test.csv', '/etc/passwd', '..', '.',
+                     'test..csv', 'a\\b.csv', 'C:test.csv', '']:
+            self.assertEquals(lookup_editor._safe_basename(name), os.path.basename(name))
+
 if __name__ == "__main__":
     loader = unittest.TestLoader()
     suites = []
     suites.append(loader.loadTestsFromTestCase(TestLookupEditController))
+    suites.append(loader.loadTestsFromTestCase(TestProjectRows))
+    suites.append(loader.loadTestsFromTestCase(TestExpiringCache))
+    suites.append(loader.loadTestsFromTestCase(TestInferKVFields))
+    suites.append(loader.loadTestsFromTestCase(TestIterKVLookup))
+    suites.append(loader.loadTestsFromTestCase(TestSafeBasename))
     
     unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(suites))
\ No newline at end of file